@@ -12,6 +12,7 @@ from typing import List
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from fairseq import utils
 from fairseq.data import Dictionary
 from fairseq.data.audio.data_cfg import MultitaskConfig, S2SDataConfig
@@ -24,9 +25,53 @@ from fairseq.tasks import LegacyFairseqTask, register_task
 from fairseq.tasks.speech_to_text import DummyMultiTask
 from fairseq.tasks.text_to_speech import batch_mel_cepstral_distortion
 
+from agent.ctc_utils import ctc_collapse, warmup_ctc_collapse
+
 logger = logging.getLogger(__name__)
 
 
+class FusedCTCHead(nn.Module):
+    """
+    Output projections of several CTC decoders reading the same encoder output,
+    concatenated into a single weight matrix, so that all of their logits come
+    from one matmul. The logits are passed to each CTCDecoder as ``ctc_logits``.
+    """
+
+    def __init__(self, projs, task_names):
+        super().__init__()
+        self.weight = nn.Parameter(
+            torch.cat([proj.weight for proj in projs], dim=0), requires_grad=False
+        )
+        self.bias = nn.Parameter(
+            torch.cat([proj.bias for proj in projs], dim=0), requires_grad=False
+        )
+
+        self.slices = {}
+        offset = 0
+        for name, proj in zip(task_names, projs):
+            self.slices[name] = slice(offset, offset + proj.out_features)
+            offset += proj.out_features
+
+    @classmethod
+    def build(cls, model, task_names):
+        """Return None unless every decoder is a plain output projection."""
+        projs = []
+        for name in task_names:
+            decoder = getattr(model, f"{name}_decoder", None)
+            proj = getattr(decoder, "proj", None)
+            if not isinstance(proj, nn.Linear) or proj.bias is None:
+                return None
+            if len(getattr(decoder, "layers", [])) > 0:
+                return None
+            projs.append(proj)
+        return cls(projs, task_names)
+
+    def forward(self, x):
+        """Return the logits of every task for encoder output x, by task name."""
+        logits = F.linear(x, self.weight, self.bias)
+        return {name: logits[..., s] for name, s in self.slices.items()}
+
+
 class CTCDecoder(nn.Module):
     def __init__(self, tgt_dict, models):
         super().__init__()
@@ -35,9 +80,12 @@ class CTCDecoder(nn.Module):
         self.unk = tgt_dict.unk()
         self.models = models
         self.tgt_dict = tgt_dict
+        warmup_ctc_collapse()
 
     @torch.no_grad()
-    def generate(self, encoder_out, prefix=None, aux_task_name=None, **kwargs):
+    def generate(
+        self, encoder_out, prefix=None, aux_task_name=None, ctc_logits=None, **kwargs
+    ):
         model = self.models[0]
         model.eval()
 
@@ -48,15 +96,9 @@ class CTCDecoder(nn.Module):
         pred_out, attn, scores = [], [], []
 
         prev_output_tokens = None
-        decoder_name = f"{aux_task_name}_decoder" if aux_task_name else "decoder"
-        ctc_decoder = getattr(model, decoder_name)
-        ctc_out = ctc_decoder(encoder_out["encoder_out"][0], **kwargs)
-        lprobs = model.get_normalized_probs(
-            [ctc_out["encoder_out"].transpose(0, 1)], log_probs=True
+        lprobs = self._get_lprobs(
+            encoder_out["encoder_out"][0], aux_task_name, ctc_logits, **kwargs
         )
-        # never select pad, unk
-        lprobs[:, :, self.pad] = -math.inf
-        lprobs[:, :, self.unk] = -math.inf
 
         cur_pred_lprob, cur_pred_out = torch.max(lprobs, dim=2)
         scores = cur_pred_lprob
@@ -64,41 +106,83 @@ class CTCDecoder(nn.Module):
         attn = None
         alignment = None
 
-        def _ctc_postprocess(tokens):
-            _toks = tokens.int().tolist()
-            deduplicated_toks = [
-                v for i, v in enumerate(_toks) if i == 0 or v != _toks[i - 1]
-            ]
-            hyp = [
-                v
-                for v in deduplicated_toks
-                if (v != 0) and (v != self.tgt_dict.pad_index)
-            ]
-            return torch.tensor(hyp)
-
-        def _ctc_postprocess_index(tokens):
-            _toks = tokens.int().tolist()
-            deduplicated_toks = [
-                (v, i) for i, v in enumerate(_toks) if i == 0 or v != _toks[i - 1]
-            ]
-            index = [
-                i
-                for v, i in deduplicated_toks
-                if (v != 0) and (v != self.tgt_dict.pad_index)
-            ]
-            return index
-
         if prefix is not None:
 
             pred_out = torch.cat((prefix, pred_out[:, prefix.size(1) :]), dim=1)
 
-        hypos = [
+        return self._finalize_hypos(pred_out, lprobs, scores)
+
+    @torch.no_grad()
+    def generate_incremental(
+        self,
+        encoder_out,
+        prev_argmax=None,
+        prev_len=0,
+        aux_task_name=None,
+        ctc_logits=None,
+        **kwargs,
+    ):
+        """
+        Greedy CTC decoding that reuses the per-frame argmax of a previous call
+        for the first ``prev_len`` frames, which must not have changed since.
+        Only the remaining frames are projected to the vocabulary, so "lprobs"
+        and the scores of the returned hypos cover those frames only.
+        ``ctc_logits``, if given, are the logits of all frames (T x B x V).
+        """
+        model = self.models[0]
+        model.eval()
+
+        decoder_name = f"{aux_task_name}_decoder" if aux_task_name else "decoder"
+        ctc_decoder = getattr(model, decoder_name)
+        # frames are only independent of each other without transformer layers
+        if prev_argmax is None or len(getattr(ctc_decoder, "layers", [])) > 0:
+            prev_len = 0
+
+        if ctc_logits is not None:
+            ctc_logits = ctc_logits[prev_len:]
+        lprobs = self._get_lprobs(
+            encoder_out["encoder_out"][0][prev_len:],
+            aux_task_name,
+            ctc_logits,
+            **kwargs,
+        )
+
+        scores, pred_out = torch.max(lprobs, dim=2)
+        if prev_len > 0:
+            pred_out = torch.cat((prev_argmax[:, :prev_len], pred_out), dim=1)
+
+        return self._finalize_hypos(pred_out, lprobs, scores)
+
+    def _get_lprobs(self, x, aux_task_name=None, ctc_logits=None, **kwargs):
+        model = self.models[0]
+        if ctc_logits is not None:
+            # projected by the caller, e.g. with a FusedCTCHead
+            ctc_out = {"encoder_out": ctc_logits}
+        else:
+            decoder_name = f"{aux_task_name}_decoder" if aux_task_name else "decoder"
+            ctc_out = getattr(model, decoder_name)(x, **kwargs)
+        lprobs = model.get_normalized_probs(
+            [ctc_out["encoder_out"].transpose(0, 1)], log_probs=True
+        )
+        # never select pad, unk
+        lprobs[:, :, self.pad] = -math.inf
+        lprobs[:, :, self.unk] = -math.inf
+        return lprobs
+
+    def _ctc_collapse(self, pred_out):
+        pred_np = pred_out.cpu().numpy()
+        index = [ctc_collapse(p, 0, self.tgt_dict.pad_index) for p in pred_np]
+        return pred_np, index
+
+    def _finalize_hypos(self, pred_out, lprobs, scores):
+        pred_np, index = self._ctc_collapse(pred_out)
+        return [
             [
                 {
-                    "tokens": _ctc_postprocess(pred_out[b]),
+                    "tokens": torch.from_numpy(pred_np[b][index[b]]),
                     "org_tokens": pred_out[b],
                     "lprobs": lprobs,
-                    "index": _ctc_postprocess_index(pred_out[b]),
+                    "index": index[b].tolist(),
                     "attn": None,
                     "alignment": None,
                     "positional_scores": scores[b],
@@ -107,5 +191,3 @@ class CTCDecoder(nn.Module):
             ]
             for b in range(pred_out.size(0))
         ]
-
-        return hypos
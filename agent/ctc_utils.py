@@ -0,0 +1,49 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+
+try:
+    import numba
+
+    _numba_available = True
+except ImportError:
+    _numba_available = False
+
+
+def _ctc_collapse(argmax, blank, pad):
+    """
+    Return the frame indices kept by greedy CTC decoding of ``argmax``:
+    the first frame of each run of repeated tokens, skipping ``blank`` and
+    ``pad``.
+    """
+    out = np.empty(argmax.shape[0], dtype=np.int64)
+    prev = -1
+    j = 0
+    for i in range(argmax.shape[0]):
+        x = argmax[i]
+        if x != prev and x != blank and x != pad:
+            out[j] = i
+            j += 1
+        prev = x
+    return out[:j]
+
+
+def _ctc_collapse_numpy(argmax, blank, pad):
+    """Vectorized :func:`_ctc_collapse`, used when numba is not installed."""
+    keep = (argmax != blank) & (argmax != pad)
+    keep[1:] &= argmax[1:] != argmax[:-1]
+    return np.flatnonzero(keep)
+
+
+if _numba_available:
+    ctc_collapse = numba.njit(cache=True)(_ctc_collapse)
+else:
+    ctc_collapse = _ctc_collapse_numpy
+
+
+def warmup_ctc_collapse():
+    """Compile ``ctc_collapse`` ahead of the first streaming step."""
+    ctc_collapse(np.zeros(8, dtype=np.int64), 0, 1)
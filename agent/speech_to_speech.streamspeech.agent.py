@@ -130,7 +130,7 @@ class StreamSpeechS2STAgent(SpeechToSpeechAgent):
         utils.import_user_module(args)
         from agent.sequence_generator import SequenceGenerator
         from agent.ctc_generator import CTCSequenceGenerator
-        from agent.ctc_decoder import CTCDecoder
+        from agent.ctc_decoder import CTCDecoder, FusedCTCHead
         from agent.tts.vocoder import CodeHiFiGANVocoderWithDur
 
         self.ctc_generator = CTCSequenceGenerator(
@@ -139,6 +139,10 @@ class StreamSpeechS2STAgent(SpeechToSpeechAgent):
 
         self.asr_ctc_generator = CTCDecoder(tgt_dict_asr, self.models)
         self.st_ctc_generator = CTCDecoder(tgt_dict_st, self.models)
+        # both CTC heads read the same encoder output, project it once
+        self.ctc_head = FusedCTCHead.build(
+            self.models[0], ["source_unigram", "ctc_target_unigram"]
+        )
 
         self.generator = SequenceGenerator(
             self.models,
@@ -434,8 +438,14 @@ class StreamSpeechS2STAgent(SpeechToSpeechAgent):
             {"src_tokens": src_indices, "src_lengths": src_lengths}
         )
 
+        ctc_logits = {}
+        if self.ctc_head is not None:
+            ctc_logits = self.ctc_head(self.encoder_outs[0]["encoder_out"][0])
+
         finalized_asr = self.asr_ctc_generator.generate(
-            self.encoder_outs[0], aux_task_name="source_unigram"
+            self.encoder_outs[0],
+            aux_task_name="source_unigram",
+            ctc_logits=ctc_logits.get("source_unigram"),
         )
         asr_probs = torch.exp(finalized_asr[0][0]["lprobs"])
 
@@ -459,7 +469,9 @@ class StreamSpeechS2STAgent(SpeechToSpeechAgent):
                 print("Streaming ASR:", text)
 
         finalized_st = self.st_ctc_generator.generate(
-            self.encoder_outs[0], aux_task_name="ctc_target_unigram"
+            self.encoder_outs[0],
+            aux_task_name="ctc_target_unigram",
+            ctc_logits=ctc_logits.get("ctc_target_unigram"),
         )
         st_probs = torch.exp(finalized_st[0][0]["lprobs"])
 
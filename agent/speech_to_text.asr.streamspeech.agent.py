@@ -11,12 +11,13 @@ from simuleval.agents.actions import WriteAction, ReadAction
 from fairseq.checkpoint_utils import load_model_ensemble_and_task
 from fairseq.models.text_to_speech.hub_interface import TTSHubInterface
 from pathlib import Path
-from typing import Any, Dict, Optional, Union
+from typing import Any, Dict, Optional, Tuple, Union
 from fairseq.data.audio.audio_utils import convert_waveform
-from examples.speech_to_text.data_utils import extract_fbank_features
 import ast
-import math
+import atexit
+import functools
 import os
+import re
 import json
 import numpy as np
 import torch
@@ -36,8 +37,18 @@ ORG_SAMPLE_RATE = 48000
 SAMPLE_RATE = 16000
 FEATURE_DIM = 80
 BOW_PREFIX = "\u2581"
+# input samples kept on each side of a resampled span (20 ms at 48 kHz), a
+# margin over the half-length of the sox "rate" filter for 48 kHz -> 16 kHz
+RESAMPLE_CONTEXT = 960
 DEFAULT_EOS = 2
 
+# detokenization of ASR hypotheses: word-boundary marks and <unk> become spaces
+_CHAR_MAP = str.maketrans({"_": " ", BOW_PREFIX: " "})
+_TOK_RE = re.compile(r"<unk>|</?s>")
+
+# generators without per-source state, shared by agents of the same model
+_GENERATOR_CACHE: Dict[Tuple[int, int], Any] = {}
+
 
 class OnlineFeatureExtractor:
     """
@@ -53,50 +64,139 @@ class OnlineFeatureExtractor:
         self.feature_dim = args.feature_dim
         self.num_samples_per_shift = int(self.shift_size * self.sample_rate / 1000)
         self.num_samples_per_window = int(self.window_size * self.sample_rate / 1000)
-        self.len_ms_to_samples = lambda x: x * self.sample_rate / 1000
-        self.previous_residual_samples = []
+        # samples of a window not covered by its shift, and samples per shift
+        self._context_samples = int(
+            (self.window_size - self.shift_size) * self.sample_rate / 1000
+        )
+        self._shift_samples = self.num_samples_per_shift
+        # audio not yet turned into frames lives in self._ring[self._r : self._w]
+        self._ring = np.empty(ORG_SAMPLE_RATE * 60, dtype=np.float32)
+        self._w = 0
+        self._r = 0
         self.global_cmvn = args.global_cmvn
         self.device = "cuda" if args.device == "gpu" else "cpu"
+        # resampling runs through sox on the CPU, as in the preprocessing that
+        # produced the training features and the global cmvn; fbank and cmvn
+        # run on self.device. Samples are kept around each resampled span so
+        # that the filter sees real neighbours at chunk boundaries.
+        self.resample_ratio = ORG_SAMPLE_RATE // SAMPLE_RATE
+        assert RESAMPLE_CONTEXT % self.resample_ratio == 0
+        self.resample_context = RESAMPLE_CONTEXT
+        self.num_left_context = 0
+        # pinned staging buffer and side stream for asynchronous uploads
+        self._copy_stream = None
+        if self.device == "cuda":
+            self._pinned = torch.empty(
+                ORG_SAMPLE_RATE * 10, dtype=torch.float32, pin_memory=True
+            )
+            self._copy_stream = torch.cuda.Stream()
+            self._copy_done = torch.cuda.Event()
+        if self.global_cmvn is not None:
+            self._mean_t = torch.as_tensor(
+                self.global_cmvn["mean"], dtype=torch.float32, device=self.device
+            )
+            self._inv_std_t = 1.0 / torch.as_tensor(
+                self.global_cmvn["std"], dtype=torch.float32, device=self.device
+            )
         self.feature_transforms = CompositeAudioFeatureTransform.from_config_dict(
             {"feature_transforms": ["utterance_cmvn"]}
         )
 
     def clear_cache(self):
-        self.previous_residual_samples = []
-
-    def __call__(self, new_samples, sr=ORG_SAMPLE_RATE):
-        samples = new_samples
+        self._w = 0
+        self._r = 0
+        self.num_left_context = 0
+
+    def push(self, samples):
+        num_samples = len(samples)
+        if self._w + num_samples > len(self._ring):
+            # move the unread samples to the front, growing the buffer if needed
+            num_unread = self._w - self._r
+            if num_unread + num_samples > len(self._ring):
+                ring = np.empty(
+                    max(2 * len(self._ring), num_unread + num_samples),
+                    dtype=np.float32,
+                )
+            else:
+                ring = self._ring
+            ring[:num_unread] = self._ring[self._r : self._w]
+            self._ring = ring
+            self._r = 0
+            self._w = num_unread
+        self._ring[self._w : self._w + num_samples] = samples
+        self._w += num_samples
+
+    def view_unread(self):
+        return self._ring[self._r : self._w]
+
+    def to_device(self, samples):
+        if self._copy_stream is None:
+            return torch.as_tensor(samples, dtype=torch.float32, device=self.device)
+
+        # the previous upload must have left the staging buffer before reuse
+        self._copy_done.synchronize()
+        num_samples = len(samples)
+        if num_samples > self._pinned.numel():
+            self._pinned = torch.empty(
+                num_samples, dtype=torch.float32, pin_memory=True
+            )
+        staging = self._pinned[:num_samples]
+        staging.copy_(samples)
+        with torch.cuda.stream(self._copy_stream):
+            waveform = staging.to(self.device, non_blocking=True)
+            self._copy_done.record()
+        torch.cuda.current_stream().wait_stream(self._copy_stream)
+        waveform.record_stream(torch.cuda.current_stream())
+        return waveform
+
+    def __call__(self, new_samples, finished=False):
+        self.push(new_samples)
+        samples = self.view_unread()
+        left = self.num_left_context
+        # hold back the right resampling context until the source is finished
+        right = 0 if finished else self.resample_context
 
         # # num_frames is the number of frames from the new segment
-        num_frames = math.floor(
-            (len(samples) - self.len_ms_to_samples(self.window_size - self.shift_size))
-            / self.num_samples_per_shift
-        )
+        num_frames = (
+            len(samples) - left - right - self._context_samples
+        ) // self._shift_samples
+        if num_frames <= 0:
+            return torch.empty((0, self.feature_dim), device=self.device)
 
         # # the number of frames used for feature extraction
         # # including some part of thte previous segment
-        effective_num_samples = int(
-            num_frames * self.len_ms_to_samples(self.shift_size)
-            + self.len_ms_to_samples(self.window_size - self.shift_size)
+        effective_num_samples = num_frames * self._shift_samples + self._context_samples
+        # keep the samples needed by the next frames for the next call
+        next_start = left + num_frames * self._shift_samples
+        self.num_left_context = min(self.resample_context, next_start)
+        self._r += next_start - self.num_left_context
+        samples = samples[: left + effective_num_samples + self.resample_context]
+        waveform, _ = convert_waveform(
+            torch.from_numpy(samples).unsqueeze(0),
+            ORG_SAMPLE_RATE,
+            to_mono=True,
+            to_sample_rate=SAMPLE_RATE,
         )
-        samples = samples[:effective_num_samples]
-        waveform, sample_rate = convert_waveform(
-            torch.tensor([samples]), sr, to_mono=True, to_sample_rate=16000
+        ratio = self.resample_ratio
+        waveform = waveform[0, left // ratio : (left + effective_num_samples) // ratio]
+        waveform = self.to_device(waveform).unsqueeze(0)
+        # Kaldi compliance: 16-bit signed integers
+        waveform.mul_(2**15)
+        output = kaldi.fbank(
+            waveform,
+            num_mel_bins=self.feature_dim,
+            frame_length=self.window_size,
+            frame_shift=self.shift_size,
+            sample_frequency=SAMPLE_RATE,
         )
-        output = extract_fbank_features(waveform, 16000)
-        output = self.transform(output)
-        return torch.tensor(output, device=self.device)
+        return self.transform(output)
 
     def transform(self, input):
         if self.global_cmvn is None:
             return input
 
-        mean = self.global_cmvn["mean"]
-        std = self.global_cmvn["std"]
-
-        x = np.subtract(input, mean)
-        x = np.divide(x, std)
-        return x
+        # kaldi.fbank returns a fresh tensor, normalize it in place
+        return input.sub_(self._mean_t).mul_(self._inv_std_t)
 
 
 @entrypoint
@@ -112,6 +212,13 @@ class StreamSpeechASRAgent(SpeechToTextAgent):
 
         self.gpu = self.args.device == "gpu"
         self.device = "cuda" if args.device == "gpu" else "cpu"
+        self._src_lengths_buf = torch.zeros(1, dtype=torch.long, device=self.device)
+        # optionally run the encoder under bf16 autocast, CTC stays in fp32
+        self.encoder_autocast = (
+            getattr(args, "encoder_bf16", False)
+            and self.gpu
+            and torch.cuda.is_bf16_supported()
+        )
 
         self.args = args
 
@@ -123,44 +230,66 @@ class StreamSpeechASRAgent(SpeechToTextAgent):
 
         torch.set_grad_enabled(False)
 
-        tgt_dict_mt = self.dict[f"{self.models[0].mt_task_name}"]
-        tgt_dict = self.dict["tgt"]
-        tgt_dict_asr = self.dict["source_unigram"]
-        tgt_dict_st = self.dict["ctc_target_unigram"]
         args.user_dir=args.agent_dir
         utils.import_user_module(args)
-        from agent.sequence_generator import SequenceGenerator
-        from agent.ctc_generator import CTCSequenceGenerator
         from agent.ctc_decoder import CTCDecoder
-        from agent.tts.vocoder import CodeHiFiGANVocoderWithDur
 
-        self.ctc_generator = CTCSequenceGenerator(
-            tgt_dict, self.models, use_incremental_states=True
-        )
+        # the other generators are only built when first used
+        self.asr_ctc_generator = CTCDecoder(self.dict["source_unigram"], self.models)
 
-        self.asr_ctc_generator = CTCDecoder(tgt_dict_asr, self.models)
-        self.st_ctc_generator = CTCDecoder(tgt_dict_st, self.models)
+        self.lagging_k1 = args.lagging_k1
+        self.lagging_k2 = args.lagging_k2
+        self.segment_size = args.segment_size
+        self.stride_n = args.stride_n
+        self.unit_per_subword = args.unit_per_subword
+        self.stride_n2 = args.stride_n2
+        if args.extra_output_dir is not None:
+            self.asr_file = Path(args.extra_output_dir + "/asr.txt")
+            self.st_file = Path(args.extra_output_dir + "/st.txt")
+            self.unit_file = Path(args.extra_output_dir + "/unit.txt")
+            #     pass
+            self.quiet = False
+        else:
+            self.quiet = True
+        # asr.txt is opened on the first write, the output dir may not exist yet
+        self._asr_fh = None
 
-        self.generator = SequenceGenerator(
-            self.models,
-            tgt_dict,
-            beam_size=1,
-            max_len_a=1,
-            max_len_b=200,
-            max_len=0,
-            min_len=1,
-            normalize_scores=True,
-            len_penalty=1.0,
-            unk_penalty=0.0,
-            temperature=1.0,
-            match_source_len=False,
-            no_repeat_ngram_size=0,
-            search_strategy=search.BeamSearch(tgt_dict),
-            eos=tgt_dict.eos(),
-            symbols_to_strip_from_output=None,
-        )
+        self.reset()
+
+    @functools.cached_property
+    def generator(self):
+        from agent.sequence_generator import SequenceGenerator
 
-        self.generator_mt = SequenceGenerator(
+        tgt_dict = self.dict["tgt"]
+        key = (id(self.models[0]), id(tgt_dict))
+        if key not in _GENERATOR_CACHE:
+            _GENERATOR_CACHE[key] = SequenceGenerator(
+                self.models,
+                tgt_dict,
+                beam_size=1,
+                max_len_a=1,
+                max_len_b=200,
+                max_len=0,
+                min_len=1,
+                normalize_scores=True,
+                len_penalty=1.0,
+                unk_penalty=0.0,
+                temperature=1.0,
+                match_source_len=False,
+                no_repeat_ngram_size=0,
+                search_strategy=search.BeamSearch(tgt_dict),
+                eos=tgt_dict.eos(),
+                symbols_to_strip_from_output=None,
+            )
+        return _GENERATOR_CACHE[key]
+
+    @functools.cached_property
+    def generator_mt(self):
+        from agent.sequence_generator import SequenceGenerator
+
+        # not shared, it keeps the incremental states of the current source
+        tgt_dict_mt = self.dict[f"{self.models[0].mt_task_name}"]
+        generator_mt = SequenceGenerator(
             self.models,
             tgt_dict_mt,
             beam_size=1,
@@ -179,22 +308,24 @@ class StreamSpeechASRAgent(SpeechToTextAgent):
             symbols_to_strip_from_output=None,
             use_incremental_states=True,
         )
-        self.lagging_k1 = args.lagging_k1
-        self.lagging_k2 = args.lagging_k2
-        self.segment_size = args.segment_size
-        self.stride_n = args.stride_n
-        self.unit_per_subword = args.unit_per_subword
-        self.stride_n2 = args.stride_n2
-        if args.extra_output_dir is not None:
-            self.asr_file = Path(args.extra_output_dir + "/asr.txt")
-            self.st_file = Path(args.extra_output_dir + "/st.txt")
-            self.unit_file = Path(args.extra_output_dir + "/unit.txt")
-            #     pass
-            self.quiet = False
-        else:
-            self.quiet = True
+        self._generator_mt_built = True
+        return generator_mt
 
-        self.reset()
+    @functools.cached_property
+    def ctc_generator(self):
+        from agent.ctc_generator import CTCSequenceGenerator
+
+        ctc_generator = CTCSequenceGenerator(
+            self.dict["tgt"], self.models, use_incremental_states=True
+        )
+        self._ctc_generator_built = True
+        return ctc_generator
+
+    @functools.cached_property
+    def st_ctc_generator(self):
+        from agent.ctc_decoder import CTCDecoder
+
+        return CTCDecoder(self.dict["ctc_target_unigram"], self.models)
 
     @staticmethod
     def add_args(parser):
@@ -255,6 +386,18 @@ class StreamSpeechASRAgent(SpeechToTextAgent):
             action="store_true",
             help="Force the model to finish the hypothsis if the source is not finished",
         )
+        parser.add_argument(
+            "--compile-encoder",
+            default=False,
+            action="store_true",
+            help="Compile the feed-forward modules of the encoder with torch.compile",
+        )
+        parser.add_argument(
+            "--encoder-bf16",
+            default=False,
+            action="store_true",
+            help="Run the encoder under bf16 autocast on GPUs that support it",
+        )
         parser.add_argument(
             "--shift-size",
             type=int,
@@ -307,11 +450,20 @@ class StreamSpeechASRAgent(SpeechToTextAgent):
         self.post_transcription = ""
         self.unfinished_wav = None
         self.states.reset()
-        try:
+        # reset() is also called by the base class before the models are loaded
+        if getattr(self, "feature_extractor", None) is not None:
+            self.feature_extractor.clear_cache()
+        # encoder state across the chunks of the current source
+        self._encoder_cache = {}
+        self._processed_samples = 0
+        # per-frame CTC argmax of the previous step, valid for its final frames
+        self._ctc_argmax_cache = None
+        self._ctc_cache_len = 0
+        # only reset the generators that have been built
+        if getattr(self, "_generator_mt_built", False):
             self.generator_mt.reset_incremental_states()
+        if getattr(self, "_ctc_generator_built", False):
             self.ctc_generator.reset_incremental_states()
-        except:
-            pass
 
     def to_device(self, tensor):
         if self.gpu:
@@ -359,20 +511,27 @@ class StreamSpeechASRAgent(SpeechToTextAgent):
         )
 
         chunk_size = args.source_segment_size // 40
+        # the convolution sublayers use chunks of at most 16 frames
+        conv_chunk_size = min(chunk_size, 16)
 
         self.models = models
 
         for model in self.models:
             model.eval()
-            model.share_memory()
             if self.gpu:
                 model.cuda()
+            else:
+                model.share_memory()
             model.encoder.chunk_size = chunk_size
-            chunk_size = min(chunk_size, 16)
             for conv in model.encoder.subsample.conv_layers:
-                conv.chunk_size = chunk_size
+                conv.chunk_size = conv_chunk_size
             for layer in model.encoder.conformer_layers:
-                layer.conv_module.depthwise_conv.chunk_size = chunk_size
+                layer.conv_module.depthwise_conv.chunk_size = conv_chunk_size
+                if getattr(args, "compile_encoder", False):
+                    # the number of frames grows every step, so compile for
+                    # dynamic shapes rather than one graph per length
+                    layer.ffn1 = torch.compile(layer.ffn1, dynamic=True)
+                    layer.ffn2 = torch.compile(layer.ffn2, dynamic=True)
 
         # Set dictionary
         self.dict = {}
@@ -381,42 +540,80 @@ class StreamSpeechASRAgent(SpeechToTextAgent):
         for k, v in task.multitask_tasks.items():
             self.dict[k] = v.tgt_dict
 
+        # string table for gathering the symbols of ASR hypotheses
+        asr_dict = self.dict["source_unigram"]
+        self._asr_vocab = np.array(
+            [asr_dict[i] for i in range(len(asr_dict))], dtype=object
+        )
+
     @torch.inference_mode()
     def policy(self):
 
-        feature = self.feature_extractor(self.states.source)
+        # only the samples received since the last call become new frames
+        new_samples = self.states.source[self._processed_samples :]
+        self._processed_samples = len(self.states.source)
+        feature = self.feature_extractor(
+            new_samples, finished=self.states.source_finished
+        )
         if feature.size(0) == 0 and not self.states.source_finished:
             return ReadAction()
 
-        src_indices = feature.unsqueeze(0)
-        src_lengths = torch.tensor([feature.size(0)], device=self.device).long()
-
-        self.encoder_outs = self.generator.model.forward_encoder(
-            {"src_tokens": src_indices, "src_lengths": src_lengths}
-        )
-
-        finalized_asr = self.asr_ctc_generator.generate(
-            self.encoder_outs[0], aux_task_name="source_unigram"
-        )
-        asr_probs = torch.exp(finalized_asr[0][0]["lprobs"])
+        self._src_lengths_buf.fill_(feature.size(0))
+        src_lengths = self._src_lengths_buf
+        src_indices = feature.unsqueeze_(0)
+
+        with torch.autocast(
+            device_type=self.device,
+            dtype=torch.bfloat16,
+            enabled=self.encoder_autocast,
+        ):
+            self.encoder_outs = self.generator.model.forward_encoder(
+                {
+                    "src_tokens": src_indices,
+                    "src_lengths": src_lengths,
+                    "incremental_state": self._encoder_cache,
+                }
+            )
+        if self.encoder_autocast:
+            self.encoder_outs[0]["encoder_out"] = [
+                self.encoder_outs[0]["encoder_out"][0].float()
+            ]
 
+        if self.states.source_finished:
+            finalized_asr = self.asr_ctc_generator.generate(
+                self.encoder_outs[0], aux_task_name="source_unigram"
+            )
+        else:
+            finalized_asr = self.asr_ctc_generator.generate_incremental(
+                self.encoder_outs[0],
+                prev_argmax=self._ctc_argmax_cache,
+                prev_len=self._ctc_cache_len,
+                aux_task_name="source_unigram",
+            )
+            self._ctc_argmax_cache = finalized_asr[0][0]["org_tokens"].unsqueeze(0)
+            self._ctc_cache_len = self.models[0].encoder.get_num_final_frames(
+                self._encoder_cache
+            )
         for i, hypo in enumerate(finalized_asr):
             i_beam = 0
-            tmp = hypo[i_beam]["tokens"].int()  # hyp + eos
+            # one transfer to the host, then a single gather from the vocab table
+            tmp = hypo[i_beam]["tokens"].to(torch.int32, copy=False).cpu().numpy()
             src_ctc_indices = tmp
             src_ctc_index = hypo[i_beam]["index"]
-            tokens = [self.dict["source_unigram"][c] for c in tmp]
-            text = "".join([self.dict["source_unigram"][c] for c in tmp])
-            text = text.replace("_", " ")
-            text = text.replace("▁", " ")
-            text = text.replace("<unk>", " ")
-            text = text.replace("<s>", "")
-            text = text.replace("</s>", "")
+            tokens = self._asr_vocab[tmp]
+
+        if self.states.source_finished and not self.quiet:
+            # the detokenized transcript is only needed for asr.txt
+            text = _TOK_RE.sub(
+                lambda m: " " if m.group() == "<unk>" else "",
+                "".join(tokens).translate(_CHAR_MAP),
+            )
             if len(text) > 0 and text[0] == " ":
                 text = text[1:]
-            if self.states.source_finished and not self.quiet:
-                with open(self.asr_file, "a") as file:
-                    print(text, file=file)
+            if self._asr_fh is None:
+                self._asr_fh = open(self.asr_file, "a", buffering=1)
+                atexit.register(self._asr_fh.close)
+            self._asr_fh.write(text + "\n")
 
         text = " ".join(tokens)
         new_text = text[len(self.asr_text) :]
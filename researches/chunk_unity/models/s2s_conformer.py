@@ -48,9 +48,19 @@ class ChunkS2SConformerEncoder(ChunkS2TConformerEncoder):
             )
 
     def forward(
-        self, src_tokens, src_lengths, tgt_speaker=None, return_all_hiddens=False
+        self,
+        src_tokens,
+        src_lengths,
+        tgt_speaker=None,
+        return_all_hiddens=False,
+        incremental_state=None,
     ):
-        out = super().forward(src_tokens, src_lengths, return_all_hiddens)
+        out = super().forward(
+            src_tokens,
+            src_lengths,
+            return_all_hiddens,
+            incremental_state=incremental_state,
+        )
 
         if self.spk_emb_proj:
             x = out["encoder_out"][0]
@@ -11,6 +11,7 @@ import torch
 from fairseq import utils
 from fairseq import checkpoint_utils
 from fairseq.data.data_utils import lengths_to_padding_mask
+from fairseq.incremental_decoding_utils import with_incremental_state
 from fairseq.models import FairseqEncoder, register_model, register_model_architecture
 
 # from fairseq.models.speech_to_text.modules.convolution import (
@@ -30,10 +31,14 @@ from fairseq.models.speech_to_text.s2t_transformer import (
 )
 from fairseq.modules import PositionalEmbedding, RelPositionalEncoding
 from chunk_unity.modules.conformer_layer import ChunkConformerEncoderLayer
+from uni_unity.modules.espnet_multihead_attention import (
+    RelPositionMultiHeadedAttention,
+)
 
 logger = logging.getLogger(__name__)
 
 
+@with_incremental_state
 class ChunkS2TConformerEncoder(FairseqEncoder):
     """Conformer Encoder for speech translation based on https://arxiv.org/abs/2005.08100"""
 
@@ -162,7 +167,150 @@ class ChunkS2TConformerEncoder(FairseqEncoder):
             "src_lengths": [],
         }
 
-    def forward(self, src_tokens, src_lengths, return_all_hiddens=False):
+    def _incremental_block_size(self):
+        """Number of encoder frames after which the subsampler, the chunk mask
+        and the depthwise convs all start a new chunk, or None if the encoder
+        cannot be computed incrementally."""
+        if (
+            not self.chunk
+            or self.conv_version != "s2t_transformer"
+            or self.pos_enc_type != "rel_pos"
+            or len(self.subsample.conv_layers) != 2
+        ):
+            return None
+        conv1, conv2 = self.subsample.conv_layers
+        # each subsample conv halves the length chunk by chunk
+        if (
+            not 0 < conv1.chunk_size < 999
+            or conv1.chunk_size % 2 != 0
+            or conv2.chunk_size != conv1.chunk_size
+        ):
+            return None
+        chunk_sizes = [max(self.chunk_size, 1), conv1.chunk_size]
+        for layer in self.conformer_layers:
+            if not isinstance(layer.self_attn, RelPositionMultiHeadedAttention):
+                return None
+            conv = layer.conv_module.depthwise_conv
+            if not 0 < getattr(conv, "chunk_size", 0) < 999:
+                return None
+            chunk_sizes.append(conv.chunk_size)
+        return math.lcm(*chunk_sizes)
+
+    def _incremental_src_context(self):
+        """Number of already consumed input frames to feed the subsampler again,
+        so that its first kept output frame sees its full left context."""
+        conv1, conv2 = self.subsample.conv_layers
+        chunk_size = conv1.chunk_size
+        padding1 = (conv1.kernel_size[0] // 2) * conv1.dilation[0]
+        padding2 = (conv2.kernel_size[0] // 2) * conv2.dilation[0]
+        context = 2 * padding2 + math.ceil(padding1 / chunk_size) * chunk_size
+        return math.ceil(context / (2 * chunk_size)) * 2 * chunk_size
+
+    def _forward_incremental(self, src_tokens, incremental_state, src_lengths=None):
+        """
+        Encode new input frames given the state of the previous calls. Encoder
+        frames are cached once no later input can change them, i.e. once every
+        chunk they depend on is complete; the remaining frames are recomputed.
+
+        Args:
+            src_tokens: New input frames of shape B X T X C
+            incremental_state: dictionary used for storing state across calls
+            src_lengths: lengths of the new input frames of shape B (optional)
+        Returns:
+            the same dictionary as :meth:`_forward`, covering all frames so far
+        """
+        saved_state = self.get_incremental_state(incremental_state, "encoder_state")
+        if saved_state is None:
+            saved_state = {}
+        prev_src_tokens = saved_state.get("src_tokens")
+        if prev_src_tokens is not None:
+            src_tokens = torch.cat([prev_src_tokens, src_tokens], dim=1)
+
+        if src_lengths is None:
+            src_lengths = torch.full(
+                (src_tokens.size(0),),
+                src_tokens.size(1),
+                dtype=torch.long,
+                device=src_tokens.device,
+            )
+        elif prev_src_tokens is not None:
+            # the buffered input frames precede the new ones
+            src_lengths = src_lengths + prev_src_tokens.size(1)
+
+        block_size = self._incremental_block_size()
+        if block_size is None:
+            # keep the whole input and encode it from scratch
+            saved_state["src_tokens"] = src_tokens.clone()
+            self.set_incremental_state(incremental_state, "encoder_state", saved_state)
+            return self._forward(src_tokens, src_lengths)
+
+        prev_encoder_out = saved_state.get("encoder_out")
+        num_committed = 0 if prev_encoder_out is None else prev_encoder_out.size(0)
+        src_context = self._incremental_src_context()
+        src_offset = max(4 * num_committed - src_context, 0)
+
+        x, _ = self.subsample(src_tokens, src_lengths)  # returns T X B X C
+        x = x[num_committed - src_offset // 4 :]
+        num_new = x.size(0)
+        num_total = num_committed + num_new
+        x = self.embed_scale * x
+
+        # relative distances from num_total - 1 down to -(num_new - 1)
+        self.embed_positions.extend_pe(x.new_empty(1, num_total))
+        center = self.embed_positions.pe.size(1) // 2
+        positions = self.embed_positions.pe[
+            :, center - num_total + 1 : center + num_new
+        ].transpose(0, 1)
+
+        x = self.linear(x)
+        x = self.dropout(x)
+
+        chunk_size = max(self.chunk_size, 1)
+        idx = torch.arange(num_committed, num_total, device=x.device).unsqueeze(1)
+        idx = (idx // chunk_size + 1) * chunk_size
+        tmp = torch.arange(0, num_total, device=x.device).unsqueeze(0)
+
+        num_final = (src_offset + src_tokens.size(1)) // (4 * block_size) * block_size
+        num_commit = min(max(num_final - num_committed, 0), num_new)
+        extra = {"encoder_mask": idx <= tmp, "num_commit": num_commit}
+
+        # x is T X B X C
+        for layer in self.conformer_layers:
+            x = layer.forward_incremental(x, positions, incremental_state, extra=extra)
+
+        if prev_encoder_out is not None:
+            x = torch.cat([prev_encoder_out, x], dim=0)
+        num_committed += num_commit
+        if num_commit > 0:
+            saved_state["encoder_out"] = x[:num_committed]
+        new_src_offset = max(4 * num_committed - src_context, 0)
+        saved_state["src_tokens"] = src_tokens[:, new_src_offset - src_offset :].clone()
+        self.set_incremental_state(incremental_state, "encoder_state", saved_state)
+
+        return {
+            "encoder_out": [x],  # T x B x C
+            "encoder_padding_mask": [],  # B x T
+            "encoder_embedding": [],  # B x T x C
+            "encoder_states": [],  # List[T x B x C]
+            "src_tokens": [],
+            "src_lengths": [],
+        }
+
+    def get_num_final_frames(self, incremental_state):
+        """Number of leading encoder frames cached in ``incremental_state``,
+        which later input can no longer change."""
+        saved_state = self.get_incremental_state(incremental_state, "encoder_state")
+        if saved_state is None or saved_state.get("encoder_out") is None:
+            return 0
+        return saved_state["encoder_out"].size(0)
+
+    def forward(
+        self, src_tokens, src_lengths, return_all_hiddens=False, incremental_state=None
+    ):
+        if incremental_state is not None:
+            return self._forward_incremental(
+                src_tokens, incremental_state, src_lengths=src_lengths
+            )
         if self.num_updates < self.encoder_freezing_updates:
             with torch.no_grad():
                 x = self._forward(
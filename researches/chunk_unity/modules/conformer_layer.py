@@ -4,10 +4,13 @@
 # LICENSE file in the root directory of this source tree.
 
 
-from typing import Optional
+import math
+from typing import Dict, Optional
 
 import torch
+from torch import Tensor
 
+from fairseq.incremental_decoding_utils import with_incremental_state
 from fairseq.modules import LayerNorm
 from uni_unity.modules.multihead_attention import MultiheadAttention
 from uni_unity.modules.espnet_multihead_attention import (
@@ -20,6 +23,7 @@ from fairseq.utils import get_activation_fn
 from chunk_unity.modules.chunk_causal_conv1d import ChunkCausalConv1d
 
 
+@with_incremental_state
 class ConvolutionModule(torch.nn.Module):
     """Convolution block used in the conformer block"""
 
@@ -118,6 +122,55 @@ class ConvolutionModule(torch.nn.Module):
 
         return x.transpose(1, 2)
 
+    def forward_incremental(
+        self,
+        x,
+        incremental_state: Dict[str, Dict[str, Optional[Tensor]]],
+        num_commit: int,
+    ):
+        """
+        Args:
+            x: Input of shape B X T X C, the frames following the cached ones
+            incremental_state: dictionary used for storing state across calls
+            num_commit: number of leading frames of x that are final
+        Returns:
+          Tensor of shape B X T X C
+        """
+        x = self.layer_norm(x)
+        x = x.transpose(1, 2)
+        x = self.pointwise_conv1(x)
+        x = self.glu(x)
+
+        # prepend the cached left context of the depthwise conv, kept as whole
+        # chunks so that the chunk boundaries stay aligned with a full pass
+        saved_state = self.get_incremental_state(incremental_state, "conv_state")
+        if saved_state is None:
+            saved_state = {}
+        prev_x = saved_state.get("prev_x")
+        num_prev = 0
+        if prev_x is not None:
+            num_prev = prev_x.size(-1)
+            x = torch.cat([prev_x, x], dim=-1)
+        if num_commit > 0:
+            chunk_size = self.depthwise_conv.chunk_size
+            padding = (self.depthwise_conv.kernel_size[0] // 2) * (
+                self.depthwise_conv.dilation[0]
+            )
+            context_size = math.ceil(padding / chunk_size) * chunk_size
+            saved_state["prev_x"] = x[:, :, : num_prev + num_commit][
+                :, :, -context_size:
+            ]
+            self.set_incremental_state(incremental_state, "conv_state", saved_state)
+
+        x = self.depthwise_conv(x)[:, :, num_prev:]
+        x = self.batch_norm(x)
+        x = self.activation(x)
+
+        x = self.pointwise_conv2(x)
+        x = self.dropout(x)
+
+        return x.transpose(1, 2)
+
 
 class FeedForwardModule(torch.nn.Module):
     """Positionwise feed forward layer used in conformer"""
@@ -164,6 +217,7 @@ class FeedForwardModule(torch.nn.Module):
         return self.dropout2(x)
 
 
+@with_incremental_state
 class ChunkConformerEncoderLayer(torch.nn.Module):
     """Conformer block based on https://arxiv.org/abs/2005.08100. We currently don't support relative positional encoding in MHA"""
 
@@ -310,3 +364,66 @@ class ChunkConformerEncoderLayer(torch.nn.Module):
 
         x = self.final_layer_norm(x)
         return x, (attn, layer_result)
+
+    def forward_incremental(
+        self,
+        x,
+        position_emb: torch.Tensor,
+        incremental_state: Dict[str, Dict[str, Optional[Tensor]]],
+        extra=None,
+    ):
+        """
+        Args:
+            x: Tensor of shape T X B X C, the frames following the cached ones
+            position_emb: relative positional embedding over cached and new frames
+            incremental_state: dictionary used for storing state across calls
+            extra: chunk mask of the new frames ("encoder_mask") and the number
+                of leading new frames that are final ("num_commit")
+        Returns:
+            Tensor of shape T X B X C
+        """
+        num_commit = extra["num_commit"]
+        saved_state = self.get_incremental_state(incremental_state, "attn_state")
+        if saved_state is None:
+            saved_state = {}
+
+        residual = x
+        x = self.ffn1(x)
+        x = x * 0.5 + residual
+        residual = x
+        x = self.self_attn_layer_norm(x)
+        prev_key = saved_state.get("prev_key")
+        prev_value = saved_state.get("prev_value")
+        x, key, value = self.self_attn.forward_incremental(
+            x,
+            position_emb,
+            prev_key=prev_key,
+            prev_value=prev_value,
+            extra=extra,
+        )
+        if num_commit > 0:
+            key = key[:, :, :num_commit]
+            value = value[:, :, :num_commit]
+            if prev_key is not None:
+                key = torch.cat([prev_key, key], dim=2)
+                value = torch.cat([prev_value, value], dim=2)
+            saved_state["prev_key"] = key
+            saved_state["prev_value"] = value
+            self.set_incremental_state(incremental_state, "attn_state", saved_state)
+        x = self.self_attn_dropout(x)
+        x = x + residual
+
+        residual = x
+        # TBC to BTC
+        x = x.transpose(0, 1)
+        x = self.conv_module.forward_incremental(x, incremental_state, num_commit)
+        # BTC to TBC
+        x = x.transpose(0, 1)
+        x = residual + x
+
+        residual = x
+        x = self.ffn2(x)
+        x = x * 0.5 + residual
+
+        x = self.final_layer_norm(x)
+        return x
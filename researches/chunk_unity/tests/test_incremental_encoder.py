@@ -0,0 +1,100 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import os
+import sys
+import unittest
+
+import torch
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+)
+
+from chunk_unity.models.s2t_conformer import ChunkS2TConformerEncoder  # noqa: E402
+
+
+def build_encoder(chunk_size, conv_chunk_size, kernel_size):
+    args = argparse.Namespace(
+        encoder_freezing_updates=0,
+        encoder_embed_dim=32,
+        no_scale_embedding=False,
+        conv_version="s2t_transformer",
+        chunk_size=chunk_size,
+        input_feat_per_channel=16,
+        input_channels=1,
+        conv_channels=32,
+        conv_kernel_sizes="5,5",
+        pos_enc_type="rel_pos",
+        max_source_positions=6000,
+        dropout=0.0,
+        encoder_ffn_embed_dim=64,
+        encoder_attention_heads=4,
+        encoder_layers=2,
+        depthwise_conv_kernel_size=kernel_size,
+        attn_type="espnet",
+        fp16=False,
+    )
+    encoder = ChunkS2TConformerEncoder(args).eval()
+    # non-trivial batch norm statistics, so misaligned conv inputs show up
+    for module in encoder.modules():
+        if isinstance(module, torch.nn.BatchNorm1d):
+            module.running_mean.normal_()
+            module.running_var.uniform_(0.5, 2.0)
+    # as set up by the streaming agent
+    encoder.chunk_size = chunk_size
+    for conv in encoder.subsample.conv_layers:
+        conv.chunk_size = conv_chunk_size
+    for layer in encoder.conformer_layers:
+        layer.conv_module.depthwise_conv.chunk_size = conv_chunk_size
+    return encoder
+
+
+class TestIncrementalChunkConformerEncoder(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def _check(self, encoder, feed_sizes):
+        num_frames = sum(feed_sizes)
+        features = torch.randn(1, num_frames, 16)
+        incremental_state = {}
+        pos = 0
+        with torch.no_grad():
+            for i, size in enumerate(feed_sizes):
+                # the agent passes the lengths of the new frames, others may not
+                src_lengths = torch.tensor([size]) if i % 2 == 0 else None
+                out = encoder(
+                    features[:, pos : pos + size],
+                    src_lengths,
+                    incremental_state=incremental_state,
+                )["encoder_out"][0]
+                pos += size
+                ref = encoder(features[:, :pos], torch.tensor([pos]))
+                ref = ref["encoder_out"][0]
+                self.assertEqual(out.shape, ref.shape)
+                self.assertTrue(torch.allclose(out, ref, atol=1e-4), pos)
+        self.assertGreater(encoder.get_num_final_frames(incremental_state), 0)
+
+    def test_uneven_chunks(self):
+        encoder = build_encoder(chunk_size=8, conv_chunk_size=8, kernel_size=31)
+        self.assertIsNotNone(encoder._incremental_block_size())
+        self._check(encoder, [37, 0, 5, 90, 13, 64, 1, 29, 70])
+
+    def test_commit_inside_conv_context(self):
+        # the depthwise conv looks 7 frames back, i.e. over 4 chunks of 2
+        # frames, and every call of 8 input frames commits a single chunk
+        encoder = build_encoder(chunk_size=2, conv_chunk_size=2, kernel_size=15)
+        self.assertIsNotNone(encoder._incremental_block_size())
+        self._check(encoder, [8] * 12 + [3, 11, 6])
+
+    def test_mixed_chunk_sizes(self):
+        encoder = build_encoder(chunk_size=24, conv_chunk_size=16, kernel_size=31)
+        self.assertIsNotNone(encoder._incremental_block_size())
+        self._check(encoder, [100, 17, 210, 4, 150])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -208,6 +208,69 @@ class RelPositionMultiHeadedAttention(ESPNETMultiHeadedAttention):
         scores = scores.transpose(0, 1)
         return scores, None
 
+    def forward_incremental(
+        self, x, pos_emb, prev_key=None, prev_value=None, extra=None
+    ):
+        """Compute self attention of new frames over cached and new frames.
+        Args:
+            x: Tensor of the new frames T1 X B X C
+            pos_emb: Positional embedding tensor T1+T2-1 X B X C, where T2 is
+                the number of cached frames plus T1
+            prev_key: Cached key tensor B X n_head X T2-T1 X d_k
+            prev_value: Cached value tensor B X n_head X T2-T1 X d_k
+        Returns:
+            torch.Tensor: Output tensor T1 X B X C.
+            torch.Tensor: Key tensor of the new frames B X n_head X T1 X d_k.
+            torch.Tensor: Value tensor of the new frames B X n_head X T1 X d_k.
+        """
+        x = x.transpose(0, 1)
+        pos_emb = pos_emb.transpose(0, 1)
+        q, new_k, new_v = self.forward_qkv(x, x, x)
+        if prev_key is not None:
+            k = torch.cat([prev_key, new_k], dim=2)
+            v = torch.cat([prev_value, new_v], dim=2)
+        else:
+            k, v = new_k, new_v
+        q = q.transpose(1, 2)  # (batch, time1, head, d_k)
+        n_batch_pos = pos_emb.size(0)
+        p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
+        p = p.transpose(1, 2)  # (batch, head, time1+time2-1, d_k)
+
+        q_with_bias_u = (q + self.pos_bias_u).transpose(1, 2)
+        q_with_bias_v = (q + self.pos_bias_v).transpose(1, 2)
+
+        # (batch, head, time1, time2)
+        matrix_ac = torch.matmul(q_with_bias_u, k.transpose(-2, -1))
+
+        # (batch, head, time1, time1+time2-1), column n holds relative
+        # distance time2-1-n, so query i and key j meet at time1-1-i+j
+        matrix_bd = torch.matmul(q_with_bias_v, p.transpose(-2, -1))
+        time1, time2 = q.size(1), k.size(2)
+        index = (time1 - 1 - torch.arange(time1, device=x.device)).unsqueeze(
+            1
+        ) + torch.arange(time2, device=x.device).unsqueeze(0)
+        matrix_bd = matrix_bd.gather(
+            -1, index.expand(*matrix_bd.size()[:2], time1, time2)
+        )
+
+        scores = (matrix_ac + matrix_bd) / math.sqrt(
+            self.d_k
+        )  # (batch, head, time1, time2)
+
+        if (
+            extra is not None
+            and "encoder_mask" in extra.keys()
+            and extra["encoder_mask"] is not None
+        ):
+            scores = scores.masked_fill(
+                extra["encoder_mask"].unsqueeze(0).unsqueeze(1).to(bool),
+                float("-inf"),  # (batch, head, time1, time2)
+            )
+
+        x = self.forward_attention(v, scores, None)
+        x = x.transpose(0, 1)
+        return x, new_k, new_v
+
 
 class RotaryPositionMultiHeadedAttention(ESPNETMultiHeadedAttention):
     def __init__(